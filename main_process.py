@@ -1,15 +1,22 @@
 #!/usr/bin/python3
 # Written by Ben Soutter
 
-from rpi_serial_handler import UARTHandler
+from rpi_serial_handler import UARTPool
 from rpi_neo_handler import NeoHandler
 from rpi_modbus_handler import ModbusHandler
+from rpi_history_handler import HistoryHandler
+from rpi_config_handler import ConfigHandler
 
 import logging, signal
 from systemd.journal import JournaldLogHandler
 
 # sudo pip3 install pymodbus twisted service_identity adafruit-circuitpython-neopixel systemd
 
+# ESP board addresses on each serial port, boards are numbered 1, 2, 3... in this order
+SERIAL_PORTS = {
+    '/dev/serial0': (1, 2, 3),
+}
+
 # get an instance of the logger object this module will use
 logger = logging.getLogger(__name__)
 
@@ -29,8 +36,10 @@ logger.setLevel(logging.DEBUG)
 
 if __name__ == "__main__":
     neo = NeoHandler()
-    ser = UARTHandler()
-    mb = ModbusHandler(neo_handler=neo, serial_handler=ser, logger=logger)
+    ser = UARTPool(SERIAL_PORTS)
+    hist = HistoryHandler()
+    cfg = ConfigHandler(logger=logger, boards_per_port=ser.boards_per_port)
+    mb = ModbusHandler(neo_handler=neo, serial_handler=ser, logger=logger, history_handler=hist, config_handler=cfg)
 
     def exit_gracefully():
         neo.stop_thread()
@@ -49,3 +58,7 @@ if __name__ == "__main__":
     except:
         logger.info("Stopping Threads")
         exit_gracefully()
+        mb.join()
+
+    # Closed once the Modbus thread is done so the last scan can't write to it
+    hist.close()
@@ -0,0 +1,105 @@
+# Written by Ben Soutter
+
+import ast, os
+
+config_file = "/home/pi/Desktop/MainProcess/config_values.txt"
+
+# Runtime tunables in Modbus register order: (name, min, max, default)
+TUNABLES = (
+    ('scan_interval_ms',    50,     4000,   500),   # Time between ESP board scans, kept under half of WatchdogSec
+    ('overrun_policy',      0,      2,      2),     # 0 = skip, 1 = catch up, 2 = degrade (see rpi_scan_scheduler)
+    ('uart_timeout_ms',     10,     1000,   100),   # Time to wait for an ESP reply
+    ('pulse_data_points',   2,      200,    40),    # NEO pulse smoothness
+    ('chaser_leds_on',      1,      100,    3),     # NEO chaser leds on per section
+    ('chaser_leds_off',     0,      100,    7),     # NEO chaser leds off per section
+)
+TUNABLE_NAMES = tuple(t[0] for t in TUNABLES)
+
+# Tunables loaded from an optional config file, changes are saved atomically so a power cut can't leave a half written file
+class ConfigHandler():
+    def __init__(self, filename=config_file, logger=None, boards_per_port=1):
+        self._filename = filename
+        self._logger = logger
+        self._boards_per_port = boards_per_port
+        self._mtime = None
+        self.values = {name: default for name, lo, hi, default in TUNABLES}
+        self.load()
+
+    # Range check plus the check against the other tunables
+    def validate(self, name, value):
+        values = dict(self.values)
+        values[name] = value
+        return self._in_range(name, value) and self._timing_fits(values)
+
+    def _in_range(self, name, value):
+        for t_name, lo, hi, default in TUNABLES:
+            if t_name == name:
+                return isinstance(value, int) and value >= lo and value <= hi
+        return False
+
+    # Every board on a port timing out must still fit in one scan, otherwise one missing board overruns every scan
+    def _timing_fits(self, values):
+        return values['uart_timeout_ms'] * self._boards_per_port < values['scan_interval_ms']
+
+    # Read the config file, invalid entries are ignored, returns the values that changed
+    def load(self):
+        changed = {}
+        if not os.path.isfile(self._filename):
+            return changed
+        self._mtime = os.path.getmtime(self._filename)
+        try:
+            with open(self._filename, 'r') as f:
+                data = ast.literal_eval(f.read())
+        except (ValueError, SyntaxError) as e:
+            self._log('Error: ConfigHandler() Could not read {}: {}'.format(self._filename, e))
+            return changed
+        if not isinstance(data, dict):
+            self._log('Error: ConfigHandler() {} is not a dictionary'.format(self._filename))
+            return changed
+
+        values = dict(self.values)
+        for name, value in data.items():
+            if not self._in_range(name, value):
+                self._log('Error: ConfigHandler() Ignoring invalid {} = {}'.format(name, value))
+            else:
+                values[name] = value
+        if not self._timing_fits(values):
+            self._log('Error: ConfigHandler() Ignoring uart_timeout_ms = {} with scan_interval_ms = {}, {} boards per port would overrun every scan'.format(
+                values['uart_timeout_ms'], values['scan_interval_ms'], self._boards_per_port))
+            values['uart_timeout_ms'] = self.values['uart_timeout_ms']
+            values['scan_interval_ms'] = self.values['scan_interval_ms']
+
+        for name, value in values.items():
+            if self.values[name] != value:
+                changed[name] = value
+        self.values = values
+        return changed
+
+    # Reload if the file was edited since it was last read or saved, returns the values that changed
+    def reload_if_changed(self):
+        if not os.path.isfile(self._filename) or os.path.getmtime(self._filename) == self._mtime:
+            return {}
+        return self.load()
+
+    def set(self, name, value):
+        if not self.validate(name, value):
+            raise ValueError('Error: set() {} out of range'.format(name))
+        self.values[name] = value
+
+    def save(self):
+        tmp = self._filename + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(self.values))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._filename)
+        self._mtime = os.path.getmtime(self._filename)
+
+    def registers(self):
+        return [self.values[name] for name in TUNABLE_NAMES]
+
+    def _log(self, msg):
+        if self._logger is not None:
+            self._logger.error(msg)
+        else:
+            print(msg)
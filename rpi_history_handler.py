@@ -0,0 +1,131 @@
+# Written by Ben Soutter
+
+from pymodbus.file_message import ReadFileRecordRequest, ReadFileRecordResponse, FileRecord
+from pymodbus.pdu import ModbusExceptions as merror
+import mmap, os, struct, time
+
+# History ring file structure
+# 32 Byte Header:
+#     B[0:4] Magic (NHPH)
+#     B[4:6] Version
+#     B[6:8] Sample size in bytes
+#     B[8:12] Capacity (number of samples)
+#     B[12:16] Head (next sample slot to be written)
+#     B[16:20] Count (number of valid samples, saturates at capacity)
+#     B[20:32] Reserved
+# 16 Byte Samples (big endian so they can be served as Modbus registers as is):
+#     B[0:4] Timestamp seconds
+#     B[4:6] Timestamp milliseconds
+#     B[6] Board number
+#     B[7] Status flags
+#     B[8:10] V_Amplitude
+#     B[10:12] Signed I_Amplitude
+#     B[12:14] Signed I_Phase_Shift
+#     B[14:16] Reserved
+
+history_file = "/home/pi/Desktop/MainProcess/history.bin"
+history_capacity = 4096 # Number of samples kept, 3 boards at 2 scans/s gives ~11 minutes
+
+HISTORY_MAGIC = b'NHPH'
+HISTORY_VERSION = 1
+HISTORY_HEADER = struct.Struct('>4sHHIII12x')
+HISTORY_SAMPLE = struct.Struct('>IHBBhhhH')
+HISTORY_SAMPLE_REGISTERS = HISTORY_SAMPLE.size // 2
+
+# Status flags
+HISTORY_FLAG_BOARD_ERROR = 0x01 # Board didn't respond, values are not valid
+
+# Modbus file records are limited to 10000 registers, the ring is split across consecutive files starting at 1
+HISTORY_FILE_REGISTERS = 10000
+HISTORY_FILE_SAMPLES = HISTORY_FILE_REGISTERS // HISTORY_SAMPLE_REGISTERS
+
+# Read File Record response data is limited to 0xF5 bytes, each record costs 2 bytes plus 2 per register
+HISTORY_MAX_RESPONSE_BYTES = 0xF5
+
+# Fixed size memory mapped ring of board samples, survives service restarts
+class HistoryHandler():
+    def __init__(self, filename=history_file, capacity=history_capacity):
+        if capacity < 1 or capacity > 0xffff:
+            raise ValueError('Error: HistoryHandler() Invalid capacity (1 to 65535)')
+        self.capacity = capacity
+        self.head = 0
+        self.count = 0
+
+        size = HISTORY_HEADER.size + capacity * HISTORY_SAMPLE.size
+        mode = 'r+b' if os.path.isfile(filename) else 'w+b'
+        self._file = open(filename, mode)
+        if os.path.getsize(filename) != size:
+            self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+
+        # Resume from an existing ring if it matches, otherwise start again
+        magic, version, sample_size, capacity, head, count = HISTORY_HEADER.unpack_from(self._map, 0)
+        if magic == HISTORY_MAGIC and version == HISTORY_VERSION and sample_size == HISTORY_SAMPLE.size \
+                and capacity == self.capacity and head < capacity and count <= capacity:
+            self.head = head
+            self.count = count
+        else:
+            self._map[:] = bytes(size)
+            self._write_header()
+
+    def _write_header(self):
+        HISTORY_HEADER.pack_into(self._map, 0, HISTORY_MAGIC, HISTORY_VERSION, HISTORY_SAMPLE.size,
+                                 self.capacity, self.head, self.count)
+
+    # Append a sample for one board, flags are set for an error sample
+    def append(self, board_no, v_amp=0, i_amp=0, i_shift=0, flags=0, timestamp=None):
+        if self._map is None:
+            return
+        if timestamp is None:
+            timestamp = time.time()
+        seconds = int(timestamp)
+        millis = int((timestamp - seconds) * 1000)
+        HISTORY_SAMPLE.pack_into(self._map, HISTORY_HEADER.size + self.head * HISTORY_SAMPLE.size,
+                                 seconds, millis, board_no, flags, v_amp, i_amp, i_shift, 0)
+
+        # Header updated after the sample so a reader never sees a half written slot as valid
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        self._write_header()
+
+    # Raw big endian register data, registers are numbered from the first sample slot
+    def read_registers(self, address, count):
+        if self._map is None or address < 0 or count < 1 or address + count > self.capacity * HISTORY_SAMPLE_REGISTERS:
+            raise ValueError('Error: read_registers() Address out of range')
+        start = HISTORY_HEADER.size + address * 2
+        return self._map[start:start + count * 2]
+
+    def status(self):
+        return [self.capacity, self.head, self.count, HISTORY_SAMPLE_REGISTERS]
+
+    def close(self):
+        if self._map is None:
+            return
+        self._map.flush()
+        self._map.close()
+        self._map = None
+        self._file.close()
+
+# Read File Record (function 20) serving the history ring
+# File 1 record 0 is the first register of sample slot 0, each file holds HISTORY_FILE_SAMPLES slots
+class HistoryFileRecordRequest(ReadFileRecordRequest):
+    history = None
+
+    def execute(self, context):
+        if self.history is None:
+            return self.doException(merror.IllegalFunction)
+        if sum(2 + record.record_length * 2 for record in self.records) > HISTORY_MAX_RESPONSE_BYTES:
+            return self.doException(merror.IllegalValue)
+        records = []
+        for record in self.records:
+            if record.file_number < 1 or record.record_number >= HISTORY_FILE_REGISTERS \
+                    or record.record_number + record.record_length > HISTORY_FILE_REGISTERS:
+                return self.doException(merror.IllegalAddress)
+            address = (record.file_number - 1) * HISTORY_FILE_REGISTERS + record.record_number
+            try:
+                data = self.history.read_registers(address, record.record_length)
+            except ValueError:
+                return self.doException(merror.IllegalAddress)
+            records.append(FileRecord(file_number=record.file_number, record_number=record.record_number,
+                                      record_data=data))
+        return ReadFileRecordResponse(records)
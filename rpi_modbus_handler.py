@@ -5,13 +5,23 @@ from pymodbus.device import ModbusDeviceIdentification
 from pymodbus.datastore import ModbusSequentialDataBlock, ModbusSlaveContext, ModbusServerContext
 from pymodbus.payload import BinaryPayloadBuilder, BinaryPayloadDecoder , Endian
 from threading import Thread
-from twisted.internet.task import LoopingCall
+from twisted.internet import reactor
+from rpi_scan_scheduler import ScanScheduler, SCAN_POLICY_DEGRADE
+from rpi_history_handler import HistoryFileRecordRequest, HISTORY_FLAG_BOARD_ERROR
+from rpi_neo_handler import max_zones
+from rpi_config_handler import TUNABLE_NAMES
 import os
 
 initial_volume = 35 # Initial volume register
 ocr_default_file = "/home/pi/Desktop/MainProcess/ocr_default_values.txt"
 neo_default_file = "/home/pi/Desktop/MainProcess/neo_default_values.txt"
-modbus_map_size = 100 # How many registers in the Modbus map (starting at add 0)
+modbus_map_size = 200 # How many registers in the Modbus map (starting at add 0)
+scan_interval = 0.5 # Seconds between scans of the ESP boards
+history_status_reg = 60 # History ring status registers (capacity, head, count, registers per sample), read only
+scan_status_reg = 64 # Scan timing registers (last lag, last duration, max lag, max duration in ms, overruns, skipped), read only
+max_boards = 15 # Board blocks must fit below the NEO registers at 50
+neo_zone_reg = 100 # NEO zone 1 registers, each following zone is neo_zone_size registers on
+config_reg = 160 # Runtime tunables in rpi_config_handler.TUNABLES order, applied without a restart
 
 NEO_DEFAULTS = {
     'function':     0,
@@ -22,177 +32,334 @@ NEO_DEFAULTS = {
     'blue' :        0
 }
 
+# Registers for each NEO zone in order, frequency is in 0.1Hz and brightness in %
+NEO_ZONE_FIELDS = ('start', 'length', 'function', 'frequency', 'brightness', 'red', 'green', 'blue')
+neo_zone_size = len(NEO_ZONE_FIELDS)
+
+NEO_ZONE_DEFAULTS = {
+    'start':        0,
+    'length':       0,
+    'function':     0,
+    'frequency':    10,
+    'brightness':   100,
+    'red':          0,
+    'green':        0,
+    'blue' :        0
+}
+
 # sudo pip3 install pymodbus twisted service_identity adafruit-circuitpython-neopixel
 
 class ModbusHandler(Thread):
-    def __init__(self, neo_handler, serial_handler, logger=None):
+    def __init__(self, neo_handler, serial_handler, logger=None, interval=scan_interval, overrun_policy=SCAN_POLICY_DEGRADE, history_handler=None, config_handler=None):
         self._logger = logger
         self._map_data = [0] * modbus_map_size
         self._neo_handler = neo_handler
         self._serial_handler = serial_handler
+        self._history_handler = history_handler
+        self._config_handler = config_handler
+
+        # Board register layout, one block per value indexed by board (3 boards gives 3, 6, 9 and defaults at 12)
+        self._boards = serial_handler.board_count
+        if self._boards < 1 or self._boards > max_boards:
+            raise ValueError('Error: ModbusHandler() Invalid number of boards (1 to {})'.format(max_boards))
+        self._v_amp_reg = 3
+        self._i_amp_reg = self._v_amp_reg + self._boards
+        self._i_shift_reg = self._i_amp_reg + self._boards
+        self._ocr_defaults_reg = self._i_shift_reg + self._boards
         self._esp_board_error = False
+        self._port_error = False # Serial port itself failed, not just a board that didn't answer
         self._neo_initialised = False
+        self._context = None
+        self._scheduler = ScanScheduler(self.loop_call, interval=interval, policy=overrun_policy, logger=logger)
 
         self._logger.info("Modbus Thread Started")
         Thread.__init__(self)
 
-    def loop_call(self, context):
-        # Check that we're connected
-        try:
-            for i in range(3):
-                self._serial_handler.get_values(i+1)
+    def loop_call(self, degraded=False):
+        context = (self._context,)
+        board_regs = self._ocr_defaults_reg + 1 # System and board registers, re-written to the boards on reconnect
+        # Check that we're connected, skipped when degraded so only changed boards are talked to (error state is kept)
+        if not degraded:
+            try:
+                self.poll_boards()
 
-            if self._esp_board_error == True:
-                # Board reconnected - reset all modbus registers to last good value, ensure boards are re-written over this scan
-                context[0][0].setValues(3,0,self._map_data)
-                self._map_data[0:13] = [pow(2,15)*13]
-            self._esp_board_error = False
-        except:
-            self._esp_board_error = True
+                if self._esp_board_error == True:
+                    # Board reconnected - reset board registers to last good value and re-write every board from them
+                    context[0][0].setValues(3,0,self._map_data[0:board_regs])
+                    self.write_boards(self.saved_board_values())
+                self._esp_board_error = False
+            except:
+                self._esp_board_error = True
 
         if self._esp_board_error:
-            context[0][0].setValues(3,0,[pow(2,15)]*13)
+            context[0][0].setValues(3,0,[pow(2,15)]*board_regs)
 
-        else:
-            # Check for data change
-            map_data = context[0][0].getValues(3, 0, count=modbus_map_size)
-
-            # Check current map against last read
-            if map_data != self._map_data:
-                print("different!")
-                # Find the register that was updated
-                system_v_amp_updated = False
-                system_i_amp_updated = False
-                system_i_shift_updated = False
-                for reg, (new, old) in enumerate(zip(map_data, self._map_data)):
-                    # Check each register for a difference
-                    if new != old:
-                        new = self.decode_16bit_int(new)
-                        old = self.decode_16bit_int(old)
-                        # System Change
-                        if reg >= 0 and reg <= 2:
-                            if reg == 0:
-                                system_v_amp_updated = True
-                                if new < 0 or new > 255:
-                                    context[0][0].setValues(3, 0, [self.encode_16bit_int(old)])
-                                else:
-                                    for i in range(3):
-                                        try:
-                                            self._serial_handler.set_values(board_no=i+1, v_amp=new)
-                                        except Exception as e:
-                                            print(1, e)
-                                        context[0][0].setValues(3, 3+i, [self.encode_16bit_int(new)])
-                            elif reg == 1:
-                                system_i_amp_updated = True
-                                if new < -255 or new > 255:
-                                    context[0][0].setValues(3, 1, [self.encode_16bit_int(old)])
-                                else:
-                                    for i in range(3):
-                                        try:
-                                            self._serial_handler.set_values(board_no=i+1, i_amp=new)
-                                        except Exception as e:
-                                            print(2,e)
-                                        context[0][0].setValues(3, 6+i, [self.encode_16bit_int(new)])
-                            else:
-                                system_i_shift_updated = True
-                                if new < -90 or new > 90:
-                                    context[0][0].setValues(3, 2, [self.encode_16bit_int(old)])
-                                else:
-                                    for i in range(3):
-                                        try:
-                                            self._serial_handler.set_values(board_no=i+1, i_shift=new)
-                                        except Exception as e:
-                                            print(3, e)
-                                        context[0][0].setValues(3, 9+i, [self.encode_16bit_int(new)])
-
-                        # Individual Line Voltage Updated
-                        if reg >= 3 and reg <= 5 and not system_v_amp_updated:
+        # Check for data change, while in error the board registers show the error value so they are held at
+        # their last good values and only the NEO, zone and config registers are serviced
+        map_data = context[0][0].getValues(3, 0, count=modbus_map_size)
+        if self._esp_board_error:
+            map_data[0:board_regs] = self._map_data[0:board_regs]
+
+        # Check current map against last read
+        if map_data != self._map_data:
+            print("different!")
+            # Find the register that was updated
+            system_v_amp_updated = False
+            system_i_amp_updated = False
+            system_i_shift_updated = False
+            board_writes = {} # Individual board changes, written together so each port is only visited once
+            config_updated = False
+            for reg, (new, old) in enumerate(zip(map_data, self._map_data)):
+                # Check each register for a difference
+                if new != old:
+                    new = self.decode_16bit_int(new)
+                    old = self.decode_16bit_int(old)
+                    # System Change
+                    if reg >= 0 and reg <= 2:
+                        if reg == 0:
+                            system_v_amp_updated = True
                             if new < 0 or new > 255:
-                                context[0][0].setValues(3, reg, [self.encode_16bit_int(old)])
+                                context[0][0].setValues(3, 0, [self.encode_16bit_int(old)])
                             else:
-                                context[0][0].setValues(3, 0, [300])
-                                try:
-                                    self._serial_handler.set_values(board_no=reg-2, v_amp=new)
-                                except Exception as e:
-                                    print(4,e)
-
-                        # Individual Line Current Updated
-                        if reg >= 6 and reg <= 8 and not system_i_amp_updated:
+                                for board_no, result in self._serial_handler.set_all_values(v_amp=new).items():
+                                    if isinstance(result, Exception):
+                                        print(1, board_no, result)
+                                context[0][0].setValues(3, self._v_amp_reg, [self.encode_16bit_int(new)]*self._boards)
+                        elif reg == 1:
+                            system_i_amp_updated = True
                             if new < -255 or new > 255:
-                                context[0][0].setValues(3, reg, [self.encode_16bit_int(old)])
+                                context[0][0].setValues(3, 1, [self.encode_16bit_int(old)])
                             else:
-                                context[0][0].setValues(3, 1, [300])
-                                try:
-                                    self._serial_handler.set_values(board_no=reg-5, i_amp=new)
-                                except Exception as e:
-                                    print(5,e)
-
-                        # Individual Line Current Shift Updated
-                        if reg >= 9 and reg <= 11 and not system_i_shift_updated:
+                                for board_no, result in self._serial_handler.set_all_values(i_amp=new).items():
+                                    if isinstance(result, Exception):
+                                        print(2, board_no, result)
+                                context[0][0].setValues(3, self._i_amp_reg, [self.encode_16bit_int(new)]*self._boards)
+                        else:
+                            system_i_shift_updated = True
                             if new < -90 or new > 90:
-                                context[0][0].setValues(3, reg, [self.encode_16bit_int(old)])
+                                context[0][0].setValues(3, 2, [self.encode_16bit_int(old)])
                             else:
-                                context[0][0].setValues(3, 2, [300])
-                                try:
-                                    self._serial_handler.set_values(board_no=reg-8, i_shift=new)
-                                except Exception as e:
-                                    print(6,e)
+                                for board_no, result in self._serial_handler.set_all_values(i_shift=new).items():
+                                    if isinstance(result, Exception):
+                                        print(3, board_no, result)
+                                context[0][0].setValues(3, self._i_shift_reg, [self.encode_16bit_int(new)]*self._boards)
+
+                    # Individual Line Voltage Updated
+                    if reg >= self._v_amp_reg and reg < self._v_amp_reg + self._boards and not system_v_amp_updated:
+                        if new < 0 or new > 255:
+                            context[0][0].setValues(3, reg, [self.encode_16bit_int(old)])
+                        else:
+                            context[0][0].setValues(3, 0, [300])
+                            board_writes.setdefault(reg-self._v_amp_reg+1, {})['v_amp'] = new
+
+                    # Individual Line Current Updated
+                    if reg >= self._i_amp_reg and reg < self._i_amp_reg + self._boards and not system_i_amp_updated:
+                        if new < -255 or new > 255:
+                            context[0][0].setValues(3, reg, [self.encode_16bit_int(old)])
+                        else:
+                            context[0][0].setValues(3, 1, [300])
+                            board_writes.setdefault(reg-self._i_amp_reg+1, {})['i_amp'] = new
+
+                    # Individual Line Current Shift Updated
+                    if reg >= self._i_shift_reg and reg < self._i_shift_reg + self._boards and not system_i_shift_updated:
+                        if new < -90 or new > 90:
+                            context[0][0].setValues(3, reg, [self.encode_16bit_int(old)])
+                        else:
+                            context[0][0].setValues(3, 2, [300])
+                            board_writes.setdefault(reg-self._i_shift_reg+1, {})['i_shift'] = new
+                    
+                    # Defaults Requested
+                    if reg == self._ocr_defaults_reg and new == 1:
+                        # Board changes from this scan need to be on the boards before they're read back
+                        self.write_boards(board_writes)
+                        self.ocr_write_defaults()
+                        context[0][0].setValues(3, self._ocr_defaults_reg, [0])
+
+                    # NEO Leds
+                    # Function
+                    if reg == 50:
+                        if new < 0 or new >= self._neo_handler.neo_state_no:
+                            context[0][0].setValues(3, 50, [self.encode_16bit_int(old)])
+                        else:
+                            self._neo_handler.set_function(new)
+                    # Frequency
+                    if reg == 51:
+                        if new <= 0 or new > 255:
+                            context[0][0].setValues(3, 51, [self.encode_16bit_int(old)])
+                        else:
+                            self._neo_handler.update_frequency(float(new) / 10.0)
+                    # Brightness
+                    if reg == 52:
+                        if new < 0 or new > 100:
+                            context[0][0].setValues(3, 52, [self.encode_16bit_int(old)])
+                        else:
+                            self._neo_handler.brightness = new / 100.0
+                    # Red Register
+                    if reg == 53:
+                        if new < 0 or new > 255:
+                            context[0][0].setValues(3, 53, [self.encode_16bit_int(old)])
+                        else:
+                            self._neo_handler.set_colour({'red':new})
+                    # Green Register
+                    if reg == 54:
+                        if new < 0 or new > 255:
+                            context[0][0].setValues(3, 54, [self.encode_16bit_int(old)])
+                        else:
+                            self._neo_handler.set_colour({'green':new})
+                    # Blue Register
+                    if reg == 55:
+                        if new < 0 or new > 255:
+                            context[0][0].setValues(3, 55, [self.encode_16bit_int(old)])
+                        else:
+                            self._neo_handler.set_colour({'blue':new})
+                    # Default
+                    if reg == 56 and new != 0:
+                        self.neo_write_defaults(context[0])
+                        context[0][0].setValues(3, 56, [0])
+
+                    # NEO Zones
+                    if reg >= neo_zone_reg and reg < neo_zone_reg + neo_zone_size * (max_zones - 1):
+                        self.neo_zone_changed(context[0], reg, new, old)
+
+                    # Runtime tunables
+                    if self._config_handler is not None and reg >= config_reg and reg < config_reg + len(TUNABLE_NAMES):
+                        name = TUNABLE_NAMES[reg - config_reg]
+                        if not self._config_handler.validate(name, new):
+                            context[0][0].setValues(3, reg, [self.encode_16bit_int(old)])
+                        else:
+                            self._config_handler.set(name, new)
+                            self.apply_config(name, new)
+                            config_updated = True
+
+            self.write_boards(board_writes)
+            if config_updated:
+                self._config_handler.save()
                         
-                        # Defaults Requested
-                        if reg == 12 and new == 1:
-                            self.ocr_write_defaults()
-                            context[0][0].setValues(3, 12, [0])
-
-                        # NEO Leds
-                        # Function
-                        if reg == 50:
-                            if new < 0 or new >= self._neo_handler.neo_state_no:
-                                context[0][0].setValues(3, 50, [self.encode_16bit_int(old)])
-                            else:
-                                self._neo_handler.set_function(new)
-                        # Frequency
-                        if reg == 51:
-                            if new < 0 or new > 255:
-                                context[0][0].setValues(3, 51, [self.encode_16bit_int(old)])
-                            else:
-                                self._neo_handler.update_frequency(float(new) / 10.0)
-                        # Brightness
-                        if reg == 52:
-                            if new < 0 or new > 100:
-                                context[0][0].setValues(3, 52, [self.encode_16bit_int(old)])
-                            else:
-                                self._neo_handler.brightness = new
-                        # Red Register
-                        if reg == 53:
-                            if new < 0 or new > 255:
-                                context[0][0].setValues(3, 53, [self.encode_16bit_int(old)])
-                            else:
-                                self._neo_handler.set_colour({'red':new})
-                        # Green Register
-                        if reg == 54:
-                            if new < 0 or new > 255:
-                                context[0][0].setValues(3, 54, [self.encode_16bit_int(old)])
-                            else:
-                                self._neo_handler.set_colour({'green':new})
-                        # Blue Register
-                        if reg == 55:
-                            if new < 0 or new > 255:
-                                context[0][0].setValues(3, 55, [self.encode_16bit_int(old)])
-                            else:
-                                self._neo_handler.set_colour({'blue':new})
-                        # Default
-                        if reg == 56 and new != 0:
-                            self.neo_write_defaults(context[0])
-                            context[0][0].setValues(3, 56, [0])
-                            
 
-                self._map_data = context[0][0].getValues(3, 0, count=modbus_map_size)
+            self._map_data = context[0][0].getValues(3, 0, count=modbus_map_size)
+            if self._esp_board_error:
+                self._map_data[0:board_regs] = map_data[0:board_regs]
+
+        # Update history status, kept in sync with the map so it isn't seen as a client write
+        if self._history_handler is not None:
+            status = self._history_handler.status()
+            context[0][0].setValues(3, history_status_reg, status)
+            self._map_data[history_status_reg:history_status_reg+len(status)] = status
+
+        # Scan timing from the previous scan, read only like the history status
+        status = self._scheduler.status()
+        context[0][0].setValues(3, scan_status_reg, status)
+        self._map_data[scan_status_reg:scan_status_reg+len(status)] = status
+
+        # Pick up edits to the config file
+        if self._config_handler is not None:
+            changed = self._config_handler.reload_if_changed()
+            for name, value in changed.items():
+                self.apply_config(name, value)
+            if changed:
+                registers = self._config_handler.registers()
+                context[0][0].setValues(3, config_reg, registers)
+                self._map_data[config_reg:config_reg+len(registers)] = registers
+
+        # A board that doesn't answer is shown as 0x8000 and the service stays up, only a failed port stops the watchdog
+        return not self._port_error
+
+    # Apply a runtime tunable to the running handlers
+    def apply_config(self, name, value):
+        self._logger.info("Config {} = {}".format(name, value))
+        if name == 'scan_interval_ms':
+            self._scheduler.interval = value / 1000.0
+        elif name == 'overrun_policy':
+            self._scheduler.policy = value
+        elif name == 'uart_timeout_ms':
+            self._serial_handler.set_uart_timeout(value)
+        elif name == 'pulse_data_points':
+            self._neo_handler.set_pulse_data_points(value)
+        elif name == 'chaser_leds_on':
+            self._neo_handler.chaser_leds_on = value
+        elif name == 'chaser_leds_off':
+            self._neo_handler.chaser_leds_off = value
+
+    # Read every board, one worker per serial port, raises on the first board that didn't respond
+    def poll_boards(self):
+        results = self._serial_handler.get_all_values()
+        # serial.SerialException is an OSError, timeouts from a board that didn't answer are ValueErrors
+        self._port_error = any(isinstance(values, OSError) for values in results.values())
+        error = None
+        for board_no in range(1, self._boards+1):
+            values = results.get(board_no)
+            if values is None or isinstance(values, Exception):
+                # Not polled boards (an earlier board on the same port failed) are marked as errors too
+                self.history_append(board_no, flags=HISTORY_FLAG_BOARD_ERROR)
+                error = error or values
+            else:
+                self.history_append(board_no, **values)
+        if error is not None:
+            raise error
+        return results
+
+    # Validate a NEO zone register and pass it to the neo thread, invalid values are reverted
+    def neo_zone_changed(self, context, reg, new, old):
+        zone_no = (reg - neo_zone_reg) // neo_zone_size + 1
+        field = NEO_ZONE_FIELDS[(reg - neo_zone_reg) % neo_zone_size]
+        if field in ('start', 'length'):
+            valid = new >= 0 and new <= self._neo_handler.leds
+        elif field == 'function':
+            valid = new >= 0 and new < self._neo_handler.neo_state_no
+        elif field == 'frequency':
+            valid = new > 0 and new <= 255
+        elif field == 'brightness':
+            valid = new >= 0 and new <= 100
+        else:
+            valid = new >= 0 and new <= 255
 
+        if not valid:
+            context[0].setValues(3, reg, [self.encode_16bit_int(old)])
+        else:
+            self._neo_handler.set_zone(zone_no, **self.neo_zone_settings({field: new}))
+
+    # Convert zone register values to neo thread units
+    def neo_zone_settings(self, values):
+        settings = dict(values)
+        if 'frequency' in settings:
+            settings['frequency'] = float(settings['frequency']) / 10.0
+        if 'brightness' in settings:
+            settings['brightness'] = settings['brightness'] / 100.0
+        return settings
+
+    # Per board values held in the map, used to re-write the boards after a reconnect
+    def saved_board_values(self):
+        values = {}
+        for i in range(self._boards):
+            values[i+1] = {
+                'v_amp':    self.decode_16bit_int(self._map_data[self._v_amp_reg+i]),
+                'i_amp':    self.decode_16bit_int(self._map_data[self._i_amp_reg+i]),
+                'i_shift':  self.decode_16bit_int(self._map_data[self._i_shift_reg+i])
+            }
+        return values
+
+    # Write pending individual board changes, clears board_writes
+    def write_boards(self, board_writes):
+        for board_no, result in self._serial_handler.set_many_values(board_writes).items():
+            if isinstance(result, Exception):
+                print(4, board_no, result)
+        board_writes.clear()
+
+    def history_append(self, board_no, **values):
+        if self._history_handler is not None:
+            self._history_handler.append(board_no, **values)
+
+    # Called from the signal/main thread, the stop runs on the reactor thread so it can't overlap a scan
     def stop_server(self):
+        reactor.callFromThread(self._stop_server)
+
+    def _stop_server(self):
+        self._scheduler.stop()
         # If process is stopped, stop outputting on ESPs
-        for i in range(3):
-            self._logger.info("Stopping Board No {}".format(i+1))
-            self._serial_handler.set_values(board_no=i+1, v_amp=0,i_amp=0)
+        self._logger.info("Stopping Boards 1 to {}".format(self._boards))
+        for board_no, result in self._serial_handler.set_all_values(v_amp=0,i_amp=0).items():
+            if isinstance(result, Exception):
+                self._logger.error("Stopping Board No {} failed: {}".format(board_no, result))
         StopServer()
 
     def encode_16bit_int(self,val):
@@ -208,30 +375,21 @@ class ModbusHandler(Thread):
     def ocr_write_defaults(self):
         defaults = []
         system_defaults = dict()
-        for i in range(3):
-            try:
-                try:
-                    defaults.append(self._serial_handler.get_values(i+1))
-                except Exception as e:
-                    print(7,e)
-            except Exception as e:
-                print(str(e))
-        
-        if defaults[0]['v_amp'] == defaults[1]['v_amp'] == defaults[2]['v_amp']:
-            system_defaults['sys_v_amp'] = defaults[0]['v_amp']
-        else:
-            system_defaults['sys_v_amp'] = 300
-
-        if defaults[0]['i_amp'] == defaults[1]['i_amp'] == defaults[2]['i_amp']:
-            system_defaults['sys_i_amp'] = defaults[0]['i_amp']
-        else:
-            system_defaults['sys_i_amp'] = 300
+        results = self._serial_handler.get_all_values()
+        for board_no in range(1, self._boards+1):
+            values = results.get(board_no)
+            if values is None or isinstance(values, Exception):
+                print(7, board_no, values)
+                raise ValueError('Error: ocr_write_defaults() Could not read board {}'.format(board_no))
+            defaults.append(values)
+
+        # System value is only valid if every board has the same value
+        for key in ('v_amp', 'i_amp', 'i_shift'):
+            if all(d[key] == defaults[0][key] for d in defaults):
+                system_defaults['sys_' + key] = defaults[0][key]
+            else:
+                system_defaults['sys_' + key] = 300
 
-        if defaults[0]['i_shift'] == defaults[1]['i_shift'] == defaults[2]['i_shift']:
-            system_defaults['sys_i_shift'] = defaults[0]['i_shift']
-        else:
-            system_defaults['sys_i_shift'] = 300
-        
         defaults.append(system_defaults)
 
         with open(ocr_default_file, 'w') as f:
@@ -243,12 +401,14 @@ class ModbusHandler(Thread):
             # File exists
             with open(ocr_default_file, 'r') as f:
                 data = eval(f.read())
-                for i in range(0,3):
-                    try:
-                        self._serial_handler.set_values(i+1, v_amp=data[i]['v_amp'], i_amp=data[i]['i_amp'], i_shift=data[i]['i_shift'])
-                    except Exception as e:
-                        print(8,e)
-                return data
+            # Last entry is the system values, board count changed since the file was written
+            if len(data) - 1 != self._boards:
+                return self.ocr_write_defaults()
+            values = {i+1: data[i] for i in range(self._boards)}
+            for board_no, result in self._serial_handler.set_many_values(values).items():
+                if isinstance(result, Exception):
+                    print(8, board_no, result)
+            return data
         else:
             return self.ocr_write_defaults()
 
@@ -262,7 +422,9 @@ class ModbusHandler(Thread):
                     'brightness':   context[0].getValues(3,52,count=1)[0],
                     'red':          context[0].getValues(3,53,count=1)[0],
                     'green':        context[0].getValues(3,54,count=1)[0],
-                    'blue' :        context[0].getValues(3,55,count=1)[0]
+                    'blue' :        context[0].getValues(3,55,count=1)[0],
+                    'zones':        [dict(zip(NEO_ZONE_FIELDS, context[0].getValues(3, neo_zone_reg + i * neo_zone_size, count=neo_zone_size)))
+                                     for i in range(max_zones - 1)]
                 }
         else:
             defaults = NEO_DEFAULTS
@@ -284,17 +446,24 @@ class ModbusHandler(Thread):
             hr=ModbusSequentialDataBlock(0, [0]*(modbus_map_size + 1)),
         )
         context = ModbusServerContext(slaves=store, single=True)
+        self._context = context
+
+        # Runtime tunables, applied before the boards are first talked to
+        if self._config_handler is not None:
+            for name, value in self._config_handler.values.items():
+                self.apply_config(name, value)
+            context[0].setValues(3, config_reg, self._config_handler.registers())
 
         # Read Default Values and write to ESPs, prefil Modbus Map
         ocr_defaults = self.ocr_read_defaults()
         # System values
-        context[0].setValues(3,0,[ocr_defaults[3]['sys_v_amp'],ocr_defaults[3]['sys_i_amp'],ocr_defaults[3]['sys_i_shift']])
+        context[0].setValues(3,0,[ocr_defaults[-1]['sys_v_amp'],ocr_defaults[-1]['sys_i_amp'],ocr_defaults[-1]['sys_i_shift']])
         # Voltages
-        context[0].setValues(3,3,[ocr_defaults[i]['v_amp'] for i in range(3)])
+        context[0].setValues(3,self._v_amp_reg,[ocr_defaults[i]['v_amp'] for i in range(self._boards)])
         # Current
-        context[0].setValues(3,6,[ocr_defaults[i]['i_amp'] for i in range(3)])
+        context[0].setValues(3,self._i_amp_reg,[ocr_defaults[i]['i_amp'] for i in range(self._boards)])
         # Shift
-        context[0].setValues(3,9,[ocr_defaults[i]['i_shift'] for i in range(3)])
+        context[0].setValues(3,self._i_shift_reg,[ocr_defaults[i]['i_shift'] for i in range(self._boards)])
 
         # Read NEO Pixel Defaults and fill modbus map
         neo_defaults = self.neo_read_defaults(context)
@@ -308,7 +477,20 @@ class ModbusHandler(Thread):
         # Pass neo values to neo thread
         self._neo_handler.set_colour(neo_defaults)
         self._neo_handler.set_function(neo_defaults['function'])
-        self._neo_handler.brightness = neo_defaults['brightness']
+        self._neo_handler.brightness = neo_defaults['brightness'] / 100.0
+        if neo_defaults['frequency'] > 0:
+            self._neo_handler.update_frequency(float(neo_defaults['frequency']) / 10.0)
+
+        # Zones, files written before zones existed leave them disabled
+        zones = neo_defaults.get('zones', [])
+        for i in range(max_zones - 1):
+            zone = dict(NEO_ZONE_DEFAULTS)
+            if i < len(zones):
+                zone.update(zones[i])
+            if zone['frequency'] <= 0:
+                zone['frequency'] = NEO_ZONE_DEFAULTS['frequency']
+            context[0].setValues(3, neo_zone_reg + i * neo_zone_size, [zone[field] for field in NEO_ZONE_FIELDS])
+            self._neo_handler.set_zone(i + 1, **self.neo_zone_settings(zone))
         self._neo_initialised = True
 
         # Synchronise maps on startup
@@ -333,10 +515,12 @@ class ModbusHandler(Thread):
         # identity.ModelName = 'Pymodbus Server'
         identity.MajorMinorRevision = '1.0'
 
+        # History served over Read File Record (function 20)
+        HistoryFileRecordRequest.history = self._history_handler
+
         # # TCP Server
-        loop = LoopingCall(f=self.loop_call, context=(context,))
-        loop.start(0.5, now=False) # initially delay by time
+        self._scheduler.start(now=False) # initially delay by time
 
         print("Server Running!")
-        StartTcpServer(context, identity=identity, address=("", 502))
+        StartTcpServer(context, identity=identity, address=("", 502), custom_functions=[HistoryFileRecordRequest])
         print("Exiting Modbus Server")
\ No newline at end of file
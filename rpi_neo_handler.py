@@ -2,19 +2,62 @@
 
 from threading import Thread
 from neopixel import NeoPixel
-import board, time, math
+import board, time
 
 # pip3 install adafruit-circuitpython-neopixel
 
 # number of data points for pulse output, more = smoother pulse slower max speed, less = better speed but more jerky
 pulse_data_points = 40
 
+# Longest the render loop sleeps when nothing is animating, bounds how long a change takes to show
+idle_delay = 0.05
+
+# Number of zones, zone 0 is the whole strip zone driven by the original function/colour registers
+max_zones = 8
+
+# A segment of the strip with its own effect and timing
+class NeoZone():
+    def __init__(self, start=0, length=0, function=0, colour=(0,0,0), frequency=1.0, brightness=1.0):
+        self.start = start
+        self.length = length
+        self.function = function
+        self.colour = colour
+        self.period_delay = 1.0 / float(frequency) / 2.0
+        self.brightness = brightness
+
+        # Effect position, advanced every step interval
+        self.step = 0
+        self.next_step = 0.0
+
+    # Advance the effect by however many steps are due, returns the time of the next step
+    def advance(self, now, interval):
+        if interval is None:
+            self.next_step = now + idle_delay
+        elif self.step == 0 and self.next_step == 0.0:
+            # Effect just (re)started, show the first step for a full interval
+            self.next_step = now + interval
+        elif now >= self.next_step:
+            if now - self.next_step > interval * 10:
+                # Far behind (effect changed from a static one or loop stalled), resync rather than jump ahead
+                self.step += 1
+                self.next_step = now + interval
+            else:
+                steps = int((now - self.next_step) / interval) + 1
+                self.step += steps
+                self.next_step += steps * interval
+        return self.next_step
+
+    def restart(self):
+        self.step = 0
+        self.next_step = 0.0
+
 # Main Neo Pixel Thread
 class NeoHandler(Thread):
     def __init__(self, number_of_leds=300):
         self.stop = False
         self.leds = number_of_leds
         self.pixels = NeoPixel(board.D18, 300, auto_write=False) # Hard coded 300 for timing issues TODO (should re-look at this)
+        self.pixels.brightness = 1.0 # Brightness is applied per zone when compositing
 
         # Define Neo States
         self.neo_state_off = 0
@@ -26,19 +69,17 @@ class NeoHandler(Thread):
         self.neo_state_bounce = 6
         self.neo_state_no = 7
 
-        # Initial Colour
-        self.colour = (29,60,125)
-        self.period_delay = 0.5
-        self.brightness = 0.5
-
-        # Current State
-        self.neo_state = self.neo_state_off
+        # Zone 0 covers the whole strip with the initial colour, other zones are disabled until given a length
+        self.zones = [NeoZone(0, self.leds, self.neo_state_off, (29,60,125), 1.0, 0.5)]
+        self.zones += [NeoZone() for i in range(max_zones - 1)]
 
         # Chaser Variables
         self.chaser_leds_on = 3
         self.chaser_leds_off = 7
         self.chaser_reverse = False
 
+        self.set_pulse_data_points(pulse_data_points)
+
         Thread.__init__(self)
 
     # Function to fill only selected LEDS (needed because of hard coded led number)
@@ -46,25 +87,41 @@ class NeoHandler(Thread):
         for i in range(self.leds):
             self.pixels[i] = col
 
+    # Pulse brightness curve, ramps up then back down, swapped in whole so it can change while running
+    def set_pulse_data_points(self, points):
+        pulse_vals = [pow(1.15,i) for i in range(int(points))]
+        pulse_vals = [i/max(pulse_vals) for i in pulse_vals]
+        self.pulse_vals = pulse_vals + sorted(pulse_vals, reverse=True)
+
     # Function to stop thread
     def stop_thread(self):
         self.stop = True
 
     # Update colour with any function (obsolete)
     def _update_colour(self,col):
-        self.colour = col
+        self.zones[0].colour = col
 
     # For writing preset functions, i.e. red pulsing
     def set_function(self, state, col = -1, freq = -1):
         if col != -1:
-            self.colour = col
+            self.zones[0].colour = col
         if freq != -1:
-            self.period_delay = 1.0 / float(freq) / 2.0
-        self.neo_state = state
+            self.zones[0].period_delay = 1.0 / float(freq) / 2.0
+        self.zones[0].function = state
+        self.zones[0].restart()
 
-    # Update Frequency 
+    # Update Frequency
     def update_frequency(self, freq):
-        self.period_delay = 1.0 / float(freq) / 2.0
+        self.zones[0].period_delay = 1.0 / float(freq) / 2.0
+
+    # Whole strip brightness (0 to 1)
+    @property
+    def brightness(self):
+        return self.zones[0].brightness
+
+    @brightness.setter
+    def brightness(self, value):
+        self.zones[0].brightness = value
 
     # Thread to exit gracefully
     def exit(self):
@@ -74,146 +131,121 @@ class NeoHandler(Thread):
 
     # Thread to update colour from Modbus
     def set_colour(self,colour_dict):
-        col = list(self.colour)
+        self.zones[0].colour = self._merge_colour(self.zones[0].colour, colour_dict)
+
+    def _merge_colour(self, colour, colour_dict):
+        col = list(colour)
         if 'red' in colour_dict:
             col[0] = colour_dict['red']
         if 'green' in colour_dict:
             col[1] = colour_dict['green']
         if 'blue' in colour_dict:
             col[2] = colour_dict['blue']
-        self.colour = tuple(col)
-
-    # Main thread
+        return tuple(col)
+
+    # Update any of a zone's settings: start, length, function, frequency (Hz), brightness (0 to 1), red, green, blue
+    def set_zone(self, zone_no, **settings):
+        if zone_no < 0 or zone_no >= max_zones:
+            raise ValueError('Error: set_zone() Invalid Zone Number (0 to {})'.format(max_zones - 1))
+        zone = self.zones[zone_no]
+        if 'start' in settings:
+            zone.start = int(settings['start'])
+        if 'length' in settings:
+            zone.length = int(settings['length'])
+        if 'frequency' in settings:
+            zone.period_delay = 1.0 / float(settings['frequency']) / 2.0
+        if 'brightness' in settings:
+            zone.brightness = settings['brightness']
+        zone.colour = self._merge_colour(zone.colour, settings)
+        if 'function' in settings and settings['function'] != zone.function:
+            zone.function = settings['function']
+            zone.restart()
+
+    # Part of the strip a zone covers, clipped to the strip
+    def _zone_span(self, zone):
+        return max(0, zone.start), min(self.leds, zone.start + zone.length)
+
+    # Time between effect steps for a zone, None if the effect doesn't animate
+    def _zone_interval(self, zone):
+        if zone.function in (self.neo_state_flashing, self.neo_state_alternate, self.neo_state_chase):
+            return zone.period_delay
+        # Pulse runs up and down the curve once per period
+        if zone.function == self.neo_state_pulse:
+            return zone.period_delay * 2.0 / len(self.pulse_vals)
+        # Bounce goes end to end once per half period
+        if zone.function == self.neo_state_bounce:
+            start, end = self._zone_span(zone)
+            return zone.period_delay / max(1, end - start - 1)
+        return None
+
+    # Draw a zone's current step into the frame, later zones are drawn over earlier ones
+    def _render_zone(self, zone, frame):
+        start, end = self._zone_span(zone)
+        if end <= start:
+            return
+
+        brightness = zone.brightness
+        if zone.function == self.neo_state_pulse:
+            pulse_vals = self.pulse_vals
+            brightness *= pulse_vals[zone.step % len(pulse_vals)]
+        colour = tuple(int(c * brightness) for c in zone.colour)
+        off = (0,0,0)
+
+        # Leds on
+        if zone.function == self.neo_state_solid or zone.function == self.neo_state_pulse:
+            frame[start:end] = [colour] * (end - start)
+
+        # Flash On/Off
+        elif zone.function == self.neo_state_flashing:
+            frame[start:end] = [off if zone.step % 2 else colour] * (end - start)
+
+        # Every second led alternates from on to off
+        elif zone.function == self.neo_state_alternate:
+            for i in range(start, end):
+                frame[i] = colour if (i - zone.start + zone.step) % 2 else off
+
+        # Adjustable chaser (every few leds on or off and shifts along the strip)
+        elif zone.function == self.neo_state_chase:
+            leds_on_off = self.chaser_leds_on + self.chaser_leds_off
+            shift = -zone.step if self.chaser_reverse else zone.step
+            for i in range(start, end):
+                frame[i] = colour if (i - zone.start - shift) % leds_on_off < self.chaser_leds_on else off
+
+        # Bounce 1 led swings from end to end
+        elif zone.function == self.neo_state_bounce:
+            frame[start:end] = [off] * (end - start)
+            travel = end - start - 1
+            if travel <= 0:
+                frame[start] = colour
+            else:
+                pos = zone.step % (2 * travel)
+                frame[start + (pos if pos <= travel else 2 * travel - pos)] = colour
+
+        # Leds off
+        else:
+            frame[start:end] = [off] * (end - start)
+
+    # Main thread, composites every zone into one frame and only sends the strip a changed frame
     def run(self):
-        period = False
-
-        # Initialise Chaser Values
-        reg_on = 0
-        reg_leds = 0
-        leds_on_off = self.chaser_leds_on + self.chaser_leds_off
-        led_mask = pow(2, self.leds)-1
-        for j in range(self.chaser_leds_on):
-            reg_on |= 1 << j
-
-        # Initial Pulse Values
-        pulse_x = range(pulse_data_points)
-        pulse_vals = []
-        for i in pulse_x:
-            pulse_vals.append(pow(1.15,i))
-        pulse_vals = [i/max(pulse_vals) for i in pulse_vals]
-        tmp = pulse_vals.copy()
-        tmp.sort(reverse=True)
-        pulse_vals = pulse_vals + tmp
-        
-        # Bounce variables
-        bounce_led = 0
-        bounce_dir = False
-
-        # main loop
+        shown = None
         while not self.stop:
-            # Update colour/delay time at start of each cycle
-            colour = self.colour
-            period_delay = self.period_delay
-            
-            # Reset brightness if state isn't pulsing
-            if self.neo_state != self.neo_state_pulse:
-                self.pixels.brightness = self.brightness
-
-            # Leds off
-            if self.neo_state == self.neo_state_off:
-                self.fill((0,0,0))
-                self.pixels.show()
-
-            # Leds on
-            elif self.neo_state == self.neo_state_solid:
-                self.fill(colour)
-                self.pixels.show()
-
-            # Flash On/Off
-            elif self.neo_state == self.neo_state_flashing:
-                if not period:
-                    self.fill(colour)
-                    self.pixels.show()
-                else:
-                    self.fill((0,0,0))
-                    self.pixels.show()
-                time.sleep(period_delay)
-
-            # Pulsing on/off
-            elif self.neo_state == self.neo_state_pulse:
-                self.fill(colour)
-                for i in pulse_vals:
-                    self.pixels.brightness = i
-                    self.pixels.show()
-
-            # Bounce 1 led swings from end to end
-            elif self.neo_state == self.neo_state_bounce:
-                if not bounce_dir:
-                    self.fill((0,0,0))
-                    self.pixels[bounce_led] = colour
-                    if bounce_led >= self.leds - 1: 
-                        bounce_dir = True
-                    else: 
-                        bounce_led += 1
-                else:
-                    self.fill((0,0,0))
-                    self.pixels[bounce_led] = colour
-                    if bounce_led <= 0: 
-                        bounce_dir = False
-                    else: 
-                        bounce_led -= 1
+            now = time.monotonic()
+            next_frame = now + idle_delay
+            frame = [(0,0,0)] * self.leds
+
+            for zone in self.zones:
+                if zone.length <= 0:
+                    continue
+                # Invalid amount of states
+                if zone.function < 0 or zone.function >= self.neo_state_no:
+                    zone.function = self.neo_state_off
+                next_frame = min(next_frame, zone.advance(now, self._zone_interval(zone)))
+                self._render_zone(zone, frame)
+
+            if frame != shown:
+                self.pixels[0:self.leds] = frame
                 self.pixels.show()
+                shown = frame
 
-            # Adjustable chaser (every few leds on or off and shifts along the strip)
-            elif self.neo_state == self.neo_state_chase:
-                # cycle through each section of LEDs in strip
-                for i in range(leds_on_off):
-                    for j in range(int(math.ceil(float(self.leds)/float(leds_on_off)))):
-                        reg_leds |= (reg_on << (j*leds_on_off)) & led_mask
-                    
-                    # Reverse binary string if Leds to chase backwards
-                    if self.chaser_reverse:
-                        reg_leds = int(format(reg_leds, "0{}b".format(self.leds))[::-1], 2)
-                    
-                    # Shift left and mask with No of LEDs
-                    reg_on = reg_on << 1
-                    reg_on &= led_mask
-
-                    # Wrap around
-                    if i >= leds_on_off - self.chaser_leds_on: reg_on |= 1
-
-                    # Write to the LEDs
-                    for i in range(self.leds):
-                        if (1 << i) & reg_leds:
-                            self.pixels[i] = colour
-                        else:
-                            self.pixels[i] = (0,0,0)
-                    self.pixels.show()
-                    time.sleep(period_delay)
-
-                    # Reset test reg
-                    reg_leds = 0
-
-            # Every second led alternates from on to off
-            elif self.neo_state == self.neo_state_alternate:
-                if not period:
-                    for i in range(self.leds):
-                        if i % 2:
-                            self.pixels[i] = colour
-                        else:
-                            self.pixels[i] = (0,0,0)
-                    self.pixels.show()
-                else:
-                    for i in range(self.leds):
-                        if i % 2:
-                            self.pixels[i] = (0,0,0)
-                        else:
-                            self.pixels[i] = colour
-                    self.pixels.show()
-                time.sleep(period_delay)
-
-            # Invalid amount of states
-            else:   
-                self.neo_state = self.neo_state_off
-            period = not period
-        self.exit()
\ No newline at end of file
+            time.sleep(max(0.0, next_frame - time.monotonic()))
+        self.exit()
@@ -0,0 +1,152 @@
+# Written by Ben Soutter
+
+from twisted.internet import reactor
+import os, time
+
+try:
+    from systemd import daemon
+except ImportError:
+    daemon = None # Not running under systemd, watchdog heartbeat disabled
+
+# Overrun policies, what to do when a scan takes longer than the scan interval
+SCAN_POLICY_SKIP = 0 # Drop the missed intervals and realign to the next one (LoopingCall behaviour)
+SCAN_POLICY_CATCH_UP = 1 # Run the missed scans back to back until back on schedule
+SCAN_POLICY_DEGRADE = 2 # Only service changed boards for a while to let the reactor recover
+SCAN_POLICIES = (SCAN_POLICY_SKIP, SCAN_POLICY_CATCH_UP, SCAN_POLICY_DEGRADE)
+
+degrade_time = 2.0 # Seconds of degraded scans after an overrun before trying a full scan again
+max_catch_up = 10 # Maximum number of missed scans to catch up on before falling back to skipping
+watchdog_margin = 0.4 # Scan interval and degrade time are capped to this fraction of the systemd watchdog period
+
+# Watchdog period in seconds from systemd (WatchdogSec), None if the watchdog isn't enabled
+def watchdog_period():
+    try:
+        return int(os.environ['WATCHDOG_USEC']) / 1000000.0
+    except (KeyError, ValueError):
+        return None
+
+# Replacement for LoopingCall that measures reactor lag and scan duration
+# scan(degraded) returns False when a serial port has failed, which stops the watchdog heartbeat
+class ScanScheduler():
+    def __init__(self, scan, interval=0.5, policy=SCAN_POLICY_SKIP, logger=None):
+        if policy not in SCAN_POLICIES:
+            raise ValueError('Error: ScanScheduler() Invalid overrun policy {}'.format(policy))
+        self._scan = scan
+        self._logger = logger
+        self._watchdog = watchdog_period()
+        self.interval = interval
+        self.policy = policy
+
+        self._call = None
+        self._deadline = 0.0
+        self._degraded_until = 0.0
+        self.running = False
+
+        # Statistics, in seconds
+        self.last_lag = 0.0
+        self.last_duration = 0.0
+        self.max_lag = 0.0
+        self.max_duration = 0.0
+        self.overruns = 0
+        self.skipped = 0
+
+    # Capped so on time scans always feed the watchdog well within its period
+    @property
+    def interval(self):
+        return self._interval
+
+    @interval.setter
+    def interval(self, value):
+        max_interval = self._max_time()
+        if max_interval is not None and value > max_interval:
+            self._log('warning', 'Scan interval {:.0f}ms capped to {:.0f}ms by the watchdog'.format(value * 1000, max_interval * 1000))
+            value = max_interval
+        self._interval = value
+
+    def _max_time(self):
+        if self._watchdog is None:
+            return None
+        return self._watchdog * watchdog_margin
+
+    def start(self, now=True):
+        self.running = True
+        self._deadline = time.monotonic()
+        if not now:
+            self._deadline += self.interval
+        self._schedule()
+
+    def stop(self):
+        self.running = False
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+    def _schedule(self):
+        delay = max(0.0, self._deadline - time.monotonic())
+        self._call = reactor.callLater(delay, self._run)
+
+    def _run(self):
+        self._call = None
+        start = time.monotonic()
+
+        # Lag is how late the reactor got around to calling us
+        self.last_lag = start - self._deadline
+        self.max_lag = max(self.max_lag, self.last_lag)
+
+        degraded = start < self._degraded_until
+        ok = False
+        raised = False
+        try:
+            ok = self._scan(degraded=degraded)
+        except Exception as e:
+            raised = True
+            self._log('error', 'Scan raised {}'.format(e))
+        finally:
+            end = time.monotonic()
+            self.last_duration = end - start
+            self.max_duration = max(self.max_duration, self.last_duration)
+
+        self._deadline += self.interval
+        if end > self._deadline:
+            self._overrun(end)
+        elif not degraded and not raised and ok:
+            # Only a full scan finishing on time with working ports proves the service is alive
+            self._heartbeat()
+
+        if self.running:
+            self._schedule()
+
+    def _overrun(self, now):
+        self.overruns += 1
+        missed = int((now - self._deadline) / self.interval) + 1
+        self._log('warning', 'Scan overrun: took {:.0f}ms (lag {:.0f}ms), {} interval(s) missed'.format(
+            self.last_duration * 1000, self.last_lag * 1000, missed))
+
+        if self.policy == SCAN_POLICY_CATCH_UP and missed <= max_catch_up:
+            # Leave the deadline in the past, the next scans run back to back
+            return
+
+        # Realign to the next interval boundary
+        self.skipped += missed
+        self._deadline += missed * self.interval
+        if self.policy == SCAN_POLICY_DEGRADE:
+            window = degrade_time
+            if self._max_time() is not None:
+                window = min(window, self._max_time())
+            self._degraded_until = now + window
+
+    # Statistics as registers: last lag, last duration, max lag, max duration (ms), overruns, skipped intervals
+    def status(self):
+        times = [self.last_lag, self.last_duration, self.max_lag, self.max_duration]
+        counts = [self.overruns, self.skipped]
+        return [min(0xffff, max(0, int(t * 1000))) for t in times] + [min(0xffff, c) for c in counts]
+
+    def _heartbeat(self):
+        if daemon is not None:
+            daemon.notify('WATCHDOG=1')
+
+    def _log(self, level, msg):
+        if self._logger is not None:
+            getattr(self._logger, level)(msg)
+        else:
+            print(msg)
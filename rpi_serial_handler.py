@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 import serial, time
 # Serial data structure
 # 10 Byte Packet:
@@ -11,7 +12,7 @@ import serial, time
 #     B[9] End of packet (0xff)
 
 class UARTHandler():
-    def __init__(self, port='/dev/serial0', baudrate=115200):
+    def __init__(self, port='/dev/serial0', baudrate=115200, boards=(1,2,3)):
         self._PACKET_START_BYTE = 0x7e
         self._PACKET_END_BYTE = 0xff
         self._PACKET_READ_ACK = 0x77
@@ -20,6 +21,7 @@ class UARTHandler():
         self._PACKET_READ_BYTE = 2
         self._RPI_ADDRESS = 0x00
         self._UART_TIMEOUT = 100 # 100ms
+        self._boards = tuple(boards) # ESP addresses on this port
 
 
         self._packet_read = [0] * self._PACKET_LENGTH
@@ -29,14 +31,19 @@ class UARTHandler():
         self._port = serial.Serial(port, baudrate=baudrate, timeout=1)
         self._port.flushInput()
         self._port.flushOutput()
+
+    # Change the time to wait for an ESP reply on a running port
+    # (the port's own read timeout isn't used, read() is only called once a whole packet is waiting)
+    def set_uart_timeout(self, uart_timeout_ms):
+        self._UART_TIMEOUT = int(uart_timeout_ms) # 1ms per iteration
     
     def get_values(self, board_no):
         self._port.flushInput()
         v_amp = 0
         i_amp = 0
         i_shift = 0
-        if board_no != 1 and board_no != 2 and board_no != 3:
-            raise ValueError('Error: get_values() Invalid Board Number (1,2 or 3)')
+        if board_no not in self._boards:
+            raise ValueError('Error: get_values() Invalid Board Number {}'.format(self._boards))
             # return 0 # Invalid Board Number
 
         # Create Read Packet
@@ -79,8 +86,8 @@ class UARTHandler():
 
     def set_values(self, board_no, v_amp = None, i_amp = None, i_shift = None):
         self._port.flushInput()
-        if board_no != 1 and board_no != 2 and board_no != 3:
-            raise ValueError('Error: set_values() Invalid Board Number (1,2 or 3)')
+        if board_no not in self._boards:
+            raise ValueError('Error: set_values() Invalid Board Number {}'.format(self._boards))
         current_board_values = self.get_values(board_no)
 
         # Setup write packet
@@ -140,4 +147,76 @@ class UARTHandler():
             # Check for Ack
             if return_data[3] != self._PACKET_READ_ACK:
                 raise ValueError('Error: set_values() ESP proto board didn\'t acknowledge read')
-        return 1
\ No newline at end of file
+        return 1
+
+# Boards spread over one or more serial ports, boards are numbered from 1 in the order given
+# ports: {'/dev/serial0': (1,2,3), '/dev/ttyUSB0': (1,2)} gives boards 1-3 on serial0 and 4-5 on ttyUSB0
+class UARTPool():
+    def __init__(self, ports=None, baudrate=115200):
+        if ports is None:
+            ports = {'/dev/serial0': (1,2,3)}
+        self._handlers = []
+        self._boards = [] # (handler, ESP address) for each board number
+        for port, addresses in ports.items():
+            handler = UARTHandler(port, baudrate=baudrate, boards=addresses)
+            self._handlers.append(handler)
+            for address in addresses:
+                self._boards.append((handler, address))
+        self.board_count = len(self._boards)
+        self.boards_per_port = max(len(addresses) for addresses in ports.values())
+
+        # One worker per port, boards on different ports are serviced concurrently
+        self._executor = ThreadPoolExecutor(max_workers=max(1, len(self._handlers)))
+
+    def _board(self, board_no):
+        if board_no < 1 or board_no > self.board_count:
+            raise ValueError('Error: Invalid Board Number (1 to {})'.format(self.board_count))
+        return self._boards[board_no-1]
+
+    def get_values(self, board_no):
+        handler, address = self._board(board_no)
+        return handler.get_values(address)
+
+    def set_values(self, board_no, v_amp = None, i_amp = None, i_shift = None):
+        handler, address = self._board(board_no)
+        return handler.set_values(address, v_amp=v_amp, i_amp=i_amp, i_shift=i_shift)
+
+    # Run func(board_no) for the given boards, one worker per port
+    # Returns {board_no: result or exception}, with stop_on_error a port stops at its first failure so a
+    # dead port only costs one timeout per scan, boards after the failure are left out of the result
+    def _run_boards(self, func, board_nos, stop_on_error=False):
+        per_port = {}
+        for board_no in board_nos:
+            per_port.setdefault(self._board(board_no)[0], []).append(board_no)
+
+        def worker(boards):
+            results = {}
+            for board_no in boards:
+                try:
+                    results[board_no] = func(board_no)
+                except Exception as e:
+                    results[board_no] = e
+                    if stop_on_error:
+                        break
+            return results
+
+        results = {}
+        for future in [self._executor.submit(worker, boards) for boards in per_port.values()]:
+            results.update(future.result())
+        return results
+
+    # Only call between scans, handlers are shared with the port workers
+    def set_uart_timeout(self, uart_timeout_ms):
+        for handler in self._handlers:
+            handler.set_uart_timeout(uart_timeout_ms)
+
+    def get_all_values(self):
+        return self._run_boards(self.get_values, range(1, self.board_count+1), stop_on_error=True)
+
+    # values: {board_no: {'v_amp': .., 'i_amp': .., 'i_shift': ..}}, missing keys are left unchanged
+    def set_many_values(self, values):
+        return self._run_boards(lambda board_no: self.set_values(board_no, **values[board_no]), values.keys())
+
+    def set_all_values(self, v_amp = None, i_amp = None, i_shift = None):
+        kwargs = {'v_amp': v_amp, 'i_amp': i_amp, 'i_shift': i_shift}
+        return self.set_many_values({board_no: kwargs for board_no in range(1, self.board_count+1)})